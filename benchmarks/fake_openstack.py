@@ -0,0 +1,199 @@
+# Description: In-process stand-ins for the Keystone and Nova clients used
+#              by generate_email.py, backed by a synthetic cloud so the
+#              notification tools can be benchmarked without a real cloud.
+
+import random
+
+from keystoneclient.exceptions import NotFound
+from novaclient import exceptions as nova_exceptions
+
+
+class FakeResource(object):
+    """Mimic a novaclient/keystoneclient resource.
+
+    Every key in info becomes an attribute, including the extension keys
+    such as 'OS-EXT-AZ:availability_zone' which are read with getattr().
+    """
+
+    def __init__(self, info):
+        self._info = info
+        for key, value in info.iteritems():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._info.get('id'))
+
+
+class FakeServer(FakeResource):
+    pass
+
+
+class FakeProject(FakeResource):
+    pass
+
+
+class FakeUser(FakeResource):
+    pass
+
+
+class FakeRoleAssignment(FakeResource):
+    pass
+
+
+class FakeCloud(object):
+    """Synthetic inventory of projects, users, role assignments and servers.
+
+    The same seed always produces the same cloud, so results from
+    different runs are comparable. The first 'unlisted' users are left out
+    of users.list() but can still be fetched with users.get(), as happens
+    with users Keystone lists from a different backend or domain.
+    """
+
+    def __init__(self, instances=2000, projects=1000, users=3000,
+                 members=3, hosts=200, zones=('melbourne-qh2', 'monash-01'),
+                 page_size=1000, unlisted=0, seed=0):
+        rand = random.Random(seed)
+        self.page_size = page_size
+        self.zones = list(zones)
+        self.hosts = ['qh2-rcc%d' % i for i in range(1, hosts + 1)]
+
+        self.users = []
+        for i in range(users):
+            info = {'id': 'u%08d' % i,
+                    'name': 'user%d' % i,
+                    'enabled': i % 50 != 0}
+            if i % 100 != 0:
+                info['email'] = 'user%d@example.edu.au' % i
+            self.users.append(FakeUser(info))
+        self.users_by_id = dict((u.id, u) for u in self.users)
+        self.users_by_name = dict((u.name, u) for u in self.users)
+        self.listed_users = self.users[unlisted:]
+
+        self.projects = [FakeProject({'id': 'p%08d' % i,
+                                      'name': 'project-%d' % i})
+                         for i in range(projects)]
+
+        self.assignments = {}
+        for project in self.projects:
+            chosen = rand.sample(self.users, min(members, users))
+            self.assignments[project.id] = [
+                FakeRoleAssignment({'user': {'id': u.id},
+                                    'scope': {'project': {'id': project.id}}})
+                for u in chosen]
+
+        self.servers = []
+        for i in range(instances):
+            host = rand.choice(self.hosts)
+            zone = self.zones[self.hosts.index(host) % len(self.zones)]
+            self.servers.append(FakeServer({
+                'id': '%08d-0000-0000-0000-000000000000' % i,
+                'name': 'instance-%d' % i,
+                'tenant_id': rand.choice(self.projects).id,
+                'status': 'ACTIVE' if i % 10 else 'SHUTOFF',
+                'accessIPv4': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255,
+                                               i & 255),
+                'OS-EXT-AZ:availability_zone': zone,
+                'OS-EXT-SRV-ATTR:host': host}))
+        self.server_index = dict((s.id, i)
+                                 for i, s in enumerate(self.servers))
+
+    def keystone_client(self, version=3, session=None, **kwargs):
+        return FakeKeystoneClient(self)
+
+    def nova_client(self, version=2, session=None, **kwargs):
+        return FakeNovaClient(self)
+
+
+class _UserManager(object):
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get(self, user_id):
+        try:
+            return self.cloud.users_by_id[getattr(user_id, 'id', user_id)]
+        except KeyError:
+            raise NotFound()
+
+    def find(self, name=None):
+        try:
+            return self.cloud.users_by_name[name]
+        except KeyError:
+            raise NotFound()
+
+    def list(self):
+        return list(self.cloud.listed_users)
+
+
+class _ProjectManager(object):
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.projects_by_id = dict((p.id, p) for p in cloud.projects)
+
+    def get(self, project_id):
+        try:
+            return self.projects_by_id[getattr(project_id, 'id', project_id)]
+        except KeyError:
+            raise NotFound()
+
+    def list(self):
+        return list(self.cloud.projects)
+
+
+class _RoleAssignmentManager(object):
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def list(self, project=None):
+        if project is None:
+            return [a for assignments in self.cloud.assignments.itervalues()
+                    for a in assignments]
+        return list(self.cloud.assignments.get(
+            getattr(project, 'id', project), []))
+
+
+class _ServerManager(object):
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get(self, server_id):
+        try:
+            return self.cloud.servers[self.cloud.server_index[server_id]]
+        except KeyError:
+            raise nova_exceptions.NotFound(404)
+
+    def list(self, search_opts=None):
+        # Same paging contract as the Nova API: at most page_size servers
+        # per call, resuming after 'marker'.
+        opts = search_opts or {}
+        start = 0
+        if opts.get('marker'):
+            start = self.cloud.server_index[opts['marker']] + 1
+        response = []
+        for server in self.cloud.servers[start:]:
+            if 'host' in opts and \
+                    getattr(server, 'OS-EXT-SRV-ATTR:host') != opts['host']:
+                continue
+            if 'status' in opts and server.status != opts['status']:
+                continue
+            response.append(server)
+            if len(response) == self.cloud.page_size:
+                break
+        return response
+
+
+class FakeKeystoneClient(object):
+
+    def __init__(self, cloud):
+        self.users = _UserManager(cloud)
+        self.projects = _ProjectManager(cloud)
+        self.role_assignments = _RoleAssignmentManager(cloud)
+
+
+class FakeNovaClient(object):
+
+    def __init__(self, cloud):
+        self.servers = _ServerManager(cloud)
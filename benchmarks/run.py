@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# Description: Benchmark generate_email.py, send_all_email.py and mailer.py
+#              against a fake OpenStack cloud and a local SMTP sink.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.run [--instances 50000 --projects 20000 ...]
+#
+# Each run is appended to the results file and compared with the previous
+# run using the same parameters, so regressions show up as they happen.
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+import generate_email
+import membership
+import send_all_email
+
+from benchmarks.fake_openstack import FakeCloud
+from benchmarks.smtp_sink import SMTPSink
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'templates')
+RESULTS_FILE = os.path.join(REPO_DIR, 'benchmarks', 'results.jsonl')
+
+# generate_email.main() phases, in the order main() runs them.
+PHASES = ['get_instances', 'get_instances_from_file', 'get_users',
+          'generate_log', 'create_notification', 'render_templates']
+
+
+def collect_args():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the notification tools against a fake cloud')
+
+    parser.add_argument('--instances', type=int, default=2000,
+                        help='Number of servers in the fake cloud')
+    parser.add_argument('--projects', type=int, default=1000,
+                        help='Number of projects in the fake cloud')
+    parser.add_argument('--users', type=int, default=3000,
+                        help='Number of users in the fake cloud')
+    parser.add_argument('--members', type=int, default=3,
+                        help='Users with a role in each project')
+    parser.add_argument('--hosts', type=int, default=200,
+                        help='Number of compute nodes')
+    parser.add_argument('--unlisted', type=int, default=5,
+                        help='Users left out of users.list()')
+    parser.add_argument('--emails', type=int, default=500,
+                        help='Messages to deliver in the sender benchmarks')
+    parser.add_argument('-t', '--template',
+                        default='outage-notification.tmpl',
+                        help='Template to render')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the fake cloud')
+    parser.add_argument('-o', '--output', default=RESULTS_FILE,
+                        help='File to append results to (JSON lines)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Relative slowdown reported as a regression')
+
+    return parser
+
+
+@contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+@contextmanager
+def work_dir():
+    # generate_email.py expects ./templates and creates ./outbox.
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='notify-bench-')
+    os.symlink(TEMPLATE_DIR, os.path.join(path, 'templates'))
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+@contextmanager
+def phase_timers(module, names, timings):
+    """Accumulate the wall time spent in module.<name> for each name."""
+
+    def wrap(name, func):
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                result = func(*args, **kwargs)
+                # get_instances*() are generators; time the iteration too.
+                if name.startswith('get_instances'):
+                    result = list(result)
+                return result
+            finally:
+                timings[name] = timings.get(name, 0.0) + timer() - start
+        return timed
+
+    originals = dict((name, getattr(module, name)) for name in names)
+    for name, func in originals.iteritems():
+        setattr(module, name, wrap(name, func))
+    try:
+        yield timings
+    finally:
+        for name, func in originals.iteritems():
+            setattr(module, name, func)
+
+
+def bench_generate_email(cloud, template, extra_args=(),
+                         prefix='generate_email'):
+    timings = {}
+    argv = ['generate_email.py', '-t', template,
+            '-z', cloud.zones[0], '-st', '09:00 25-06-2015', '-d', '2']
+    argv.extend(extra_args)
+    with work_dir() as path, \
+            patched(generate_email, 'get_session', lambda **kwargs: None), \
+            patched(generate_email, 'save_auth_state', lambda sess: None), \
+            patched(generate_email, 'get_keystone_client',
+                    cloud.keystone_client), \
+            patched(generate_email, 'get_nova_client', cloud.nova_client), \
+            patched(sys, 'argv', argv), \
+            patched(generate_email, '_template_env', None), \
+            phase_timers(generate_email, PHASES, timings), \
+            quiet():
+        start = timer()
+        generate_email.main()
+        timings['main'] = timer() - start
+        outbox = os.path.join(path, 'outbox')
+        outbox = os.path.join(outbox, os.listdir(outbox)[0])
+        recipients = set(f for f in os.listdir(outbox) if '@' in f)
+
+    accounted = sum(timings[name] for name in PHASES
+                    if name in timings and name != 'render_templates')
+    timings['other'] = timings['main'] - accounted
+    results = dict(('%s.%s' % (prefix, name), seconds)
+                   for name, seconds in timings.iteritems())
+    return results, recipients
+
+
+def bench_render_templates(cloud, template, count):
+    servers = cloud.servers[:5]
+    instances = {'project-0': servers[:3], 'project-1': servers[3:]}
+    start_ts = generate_email.get_datetime('09:00 25-06-2015')
+    end_ts = start_ts + datetime.timedelta(hours=2)
+    with work_dir() as path:
+        filename = os.path.join(path, 'user@example.edu.au')
+        start = timer()
+        for i in range(count):
+            generate_email.render_templates(
+                'Benchmark', instances, start_ts, end_ts, 'AEDT',
+                cloud.zones[0], True, None, filename, template)
+        elapsed = timer() - start
+    return {'render_templates.total': elapsed,
+            'render_templates.per_email': elapsed / count}
+
+
+def write_inventory(cloud, filename):
+    index = membership.MembershipIndex.build(cloud.keystone_client())
+    with open(filename, 'w') as fh:
+        json.dump({'updated': index.updated,
+                   'projects': index.projects,
+                   'users': index.users,
+                   'instances': [s._info for s in cloud.servers]}, fh)
+
+
+def bench_dry_run(cloud, template):
+    # A fresh interpreter, so the time includes imports and startup.
+    with work_dir() as path:
+        inventory = os.path.join(path, 'inventory.json')
+        write_inventory(cloud, inventory)
+        cmd = [sys.executable, os.path.join(REPO_DIR, 'generate_email.py'),
+               '-t', template, '-z', cloud.zones[0],
+               '-st', '09:00 25-06-2015', '-d', '2',
+               '-i', inventory, '--dry-run']
+        with open(os.devnull, 'w') as devnull:
+            start = timer()
+            subprocess.check_call(cmd, stdout=devnull)
+            elapsed = timer() - start
+    return {'generate_email.dry_run': elapsed}
+
+
+def bench_send_all_email(sink, count):
+    text = 'Benchmark body\n' * 40
+    send_all_email.smtp_server = sink.address
+    send_all_email.smtp_obj = None
+    send_all_email.smtp_msgs_per_conn = 100
+    send_all_email.smtp_curr_msg_num = 1
+    received = sink.messages
+    with quiet():
+        start = timer()
+        for i in range(count):
+            send_all_email.send_email('user%d@example.edu.au' % i,
+                                      'Benchmark', text)
+        send_all_email.smtp_obj.quit()
+        elapsed = timer() - start
+    assert sink.messages - received == count, 'SMTP sink lost messages'
+    return {'send_all_email.send_email.total': elapsed,
+            'send_all_email.send_email.per_email': elapsed / count}
+
+
+def bench_mailer(sink, count):
+    received = sink.messages
+    with work_dir() as path:
+        users = os.path.join(path, 'users.csv')
+        with open(users, 'w') as fh:
+            for i in range(count):
+                fh.write('user%d@example.edu.au,User %d\n' % (i, i))
+        cmd = [sys.executable, os.path.join(REPO_DIR, 'mailer.py'),
+               '--users', users, '--template', 'test.tmpl',
+               '--subject', 'Benchmark', '-p', sink.address]
+        with open(os.devnull, 'w') as devnull:
+            start = timer()
+            subprocess.check_call(cmd, stdout=devnull)
+            elapsed = timer() - start
+    assert sink.messages - received == count, 'SMTP sink lost messages'
+    return {'mailer.total': elapsed,
+            'mailer.per_email': elapsed / count}
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=REPO_DIR, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(filename, params):
+    previous = None
+    if os.path.exists(filename):
+        with open(filename) as fh:
+            for line in fh:
+                record = json.loads(line)
+                if record['params'] == params:
+                    previous = record
+    return previous
+
+
+def report(results, previous, threshold):
+    print '%-45s %12s %12s %9s' % ('benchmark', 'seconds', 'previous',
+                                    'change')
+    for name in sorted(results):
+        seconds = results[name]
+        before = previous['results'].get(name) if previous else None
+        if before:
+            change = (seconds - before) / before
+            flag = '  REGRESSION' if change > threshold else ''
+            print '%-45s %12.4f %12.4f %+8.1f%%%s' % (
+                name, seconds, before, change * 100, flag)
+        else:
+            print '%-45s %12.4f %12s %9s' % (name, seconds, '-', '-')
+
+
+def main():
+
+    args = collect_args().parse_args()
+
+    params = {'instances': args.instances,
+              'projects': args.projects,
+              'users': args.users,
+              'members': args.members,
+              'hosts': args.hosts,
+              'unlisted': args.unlisted,
+              'emails': args.emails,
+              'template': args.template,
+              'seed': args.seed}
+
+    print "Building fake cloud"
+    start = timer()
+    cloud = FakeCloud(instances=args.instances, projects=args.projects,
+                      users=args.users, members=args.members,
+                      hosts=args.hosts, unlisted=args.unlisted,
+                      seed=args.seed)
+    print "Built in %.2fs" % (timer() - start)
+
+    results = {}
+
+    print "Benchmarking generate_email.main"
+    main_results, recipients = bench_generate_email(cloud, args.template)
+    results.update(main_results)
+    print "Generated %s email notifications" % len(recipients)
+
+    print "Benchmarking generate_email.main with a membership index"
+    index_dir = tempfile.mkdtemp(prefix='notify-bench-')
+    try:
+        index_file = os.path.join(index_dir, 'membership.json')
+        start = timer()
+        membership.MembershipIndex.build(
+            cloud.keystone_client()).save(index_file)
+        results['membership.build'] = timer() - start
+        main_results, indexed_recipients = bench_generate_email(
+            cloud, args.template, ['-m', index_file],
+            prefix='generate_email_indexed')
+        results.update(main_results)
+    finally:
+        shutil.rmtree(index_dir)
+    assert indexed_recipients == recipients, \
+        'membership index changed recipients'
+
+    print "Benchmarking generate_email.main with a server id file"
+    ids_dir = tempfile.mkdtemp(prefix='notify-bench-')
+    try:
+        # The servers the zone run above selected, so the recipients match.
+        ids_file = os.path.join(ids_dir, 'servers')
+        zone = cloud.zones[0]
+        with open(ids_file, 'w') as fh:
+            for server in cloud.servers:
+                if getattr(server, 'OS-EXT-AZ:availability_zone') == zone:
+                    fh.write(server.id + '\n')
+        main_results, file_recipients = bench_generate_email(
+            cloud, args.template, ['-f', ids_file],
+            prefix='generate_email_file')
+        results.update(main_results)
+    finally:
+        shutil.rmtree(ids_dir)
+    assert file_recipients == recipients, 'server id file changed recipients'
+
+    print "Benchmarking generate_email.main --digest"
+    main_results, digest_recipients = bench_generate_email(
+        cloud, 'digest-notification.tmpl', ['--digest'],
+        prefix='generate_email_digest')
+    results.update(main_results)
+    assert digest_recipients == recipients, 'digest mode changed recipients'
+
+    print "Benchmarking generate_email.py --dry-run from an inventory"
+    results.update(bench_dry_run(cloud, args.template))
+
+    print "Benchmarking generate_email.render_templates"
+    results.update(bench_render_templates(cloud, args.template, args.emails))
+
+    with SMTPSink() as sink:
+        print "Benchmarking send_all_email.send_email"
+        results.update(bench_send_all_email(sink, args.emails))
+        print "Benchmarking mailer.py"
+        results.update(bench_mailer(sink, args.emails))
+
+    previous = load_previous(args.output, params)
+    print
+    report(results, previous, args.threshold)
+
+    record = {'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'revision': git_revision(),
+              'params': params,
+              'emails': len(recipients),
+              'results': results}
+    with open(args.output, 'a') as fh:
+        fh.write(json.dumps(record, sort_keys=True) + '\n')
+    print "\nResults appended to: " + args.output
+
+
+if __name__ == '__main__':
+    main()
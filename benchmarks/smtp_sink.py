@@ -0,0 +1,49 @@
+# Description: Local SMTP server that accepts and discards every message,
+#              used as the delivery target when benchmarking the senders.
+
+import asyncore
+import smtpd
+import threading
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """Count delivered messages without relaying them anywhere.
+
+    Listens on 127.0.0.1; with the default port of 0 the OS picks a free
+    port, available afterwards as the 'address' attribute ('host:port', as
+    accepted by smtplib.SMTP).
+    """
+
+    def __init__(self, port=0):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', port), None)
+        self.address = '%s:%d' % self.socket.getsockname()
+        self.messages = 0
+        self.bytes = 0
+        self._running = False
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += len(rcpttos)
+        self.bytes += len(data)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
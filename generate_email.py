@@ -9,28 +9,57 @@
 import os
 import sys
 import re
+import json
+import shutil
 import argparse
+import hashlib
 import logging
 import datetime
-import os_client_config
+import tempfile
 from collections import OrderedDict
 
-from keystoneauth1 import identity as keystone_identity
-from keystoneauth1 import session as keystone_session
-from keystoneclient import client as keystone_client
-from keystoneclient.exceptions import NotFound
-from novaclient import client as nova_client
+import membership
 
-from jinja2 import Environment, FileSystemLoader
+# The OpenStack client stack (keystoneauth1, keystoneclient, novaclient,
+# requests) and jinja2 are imported where they are used, so that offline
+# runs from an --inventory file never load the clients.
 
 
 email_pattern = re.compile('([\w\-\.\']+@(\w[\w\-]+\.)+[\w\-]+)')
 
 OUTPUT_FORMAT = '{: <40} {: <1} {: <40} {: <1} {: <40} {: <1}'
 
+# HTTP connection pool shared by the Keystone and Nova clients.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+TOKEN_CACHE_DIR = os.path.expanduser('~/.cache/notify')
+
+# Days before the membership of a project in the index is fetched again.
+DEFAULT_INDEX_MAX_AGE = 7
+
+# Per-project instance table shared by all members in --digest mode.
+DIGEST_PROJECT_TEMPLATE = 'digest-project.tmpl'
+
+# Sessions by configuration, so every client and thread asking for the
+# same cloud and settings reuses the same connection pool and token.
+_sessions = {}
+
+# Jinja environment, kept so each template is only compiled once.
+_template_env = None
+
 
 def get_session(url=None, username=None, password=None,
-                tenant=None, version=3):
+                tenant=None, version=3, pool_size=DEFAULT_POOL_SIZE,
+                retries=DEFAULT_RETRIES, token_cache=True):
+    """Return the process-wide session for this cloud and configuration.
+
+    Sessions are cached on all of the arguments (after the OS_* environment
+    overrides), so a call with a different pool size, retry count or token
+    cache setting gets its own session rather than a mismatched one.
+    """
     url = os.environ.get('OS_AUTH_URL', url)
     username = os.environ.get('OS_USERNAME', username)
     user_domain_name = 'Default'
@@ -38,16 +67,84 @@ def get_session(url=None, username=None, password=None,
     tenant = os.environ.get('OS_TENANT_NAME', tenant)
     project_domain_name = 'Default'
     assert url and username and password and tenant
+
+    key = (url, username, password, tenant, pool_size, retries, token_cache)
+    if key in _sessions:
+        return _sessions[key]
+
+    import requests
+    from urllib3.util.retry import Retry
+    from keystoneauth1 import identity as keystone_identity
+    from keystoneauth1 import session as keystone_session
+
     auth = keystone_identity.Password(username=username,
                                       password=password,
                                       tenant_name=tenant,
                                       auth_url=url,
                                       user_domain_name=user_domain_name,
                                       project_domain_name=project_domain_name)
-    return keystone_session.Session(auth=auth)
+    if token_cache:
+        load_auth_state(auth)
+
+    # Idempotent requests are retried with exponential backoff when the
+    # API is overloaded, honouring any Retry-After header.
+    retry = Retry(total=retries, backoff_factor=RETRY_BACKOFF,
+                  status_forcelist=RETRY_STATUS_CODES,
+                  raise_on_status=False)
+    # keystoneauth's adapter also sets the TCP keep-alive and TCP_NODELAY
+    # socket options.
+    adapter = keystone_session.TCPKeepAliveAdapter(pool_connections=pool_size,
+                                                   pool_maxsize=pool_size,
+                                                   max_retries=retry)
+    http = requests.Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+
+    _sessions[key] = keystone_session.Session(auth=auth, session=http)
+    return _sessions[key]
+
+
+def get_keystone_client(sess):
+    from keystoneclient import client as keystone_client
+    return keystone_client.Client(3, session=sess)
+
+
+def get_nova_client(sess):
+    from novaclient import client as nova_client
+    return nova_client.Client(2, session=sess)
 
 
-def get_users(keystone, project):
+def get_token_cache_file(auth, cache_dir=TOKEN_CACHE_DIR):
+    # The cache id covers the auth URL and credentials, so each cloud and
+    # user gets its own file.
+    name = hashlib.sha256(auth.get_cache_id()).hexdigest()
+    return os.path.join(cache_dir, name)
+
+
+def load_auth_state(auth, cache_dir=TOKEN_CACHE_DIR):
+    # An expired token is ignored by the plugin, which then reauthenticates.
+    try:
+        with open(get_token_cache_file(auth, cache_dir)) as fh:
+            auth.set_auth_state(fh.read())
+    except (IOError, ValueError):
+        pass
+
+
+def save_auth_state(sess, cache_dir=TOKEN_CACHE_DIR):
+    state = sess.auth.get_auth_state()
+    if not state:
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0700)
+    filename = get_token_cache_file(sess.auth, cache_dir)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(state)
+
+
+def get_users(keystone, project, index=None):
+    if index is not None and project in index.projects:
+        return index.get_users(project)
     assignments = keystone.role_assignments.list(project=project)
     user_ids = set()
     for assignment in assignments:
@@ -61,6 +158,7 @@ def get_users(keystone, project):
 
 
 def get_user(keystone, name_or_id):
+    from keystoneclient.exceptions import NotFound
     try:
         user = keystone.users.get(name_or_id)
     except NotFound:
@@ -126,6 +224,41 @@ def collect_args():
                         default=None,
                         help='Only consider instances with given id\
                               listed in FILE')
+    parser.add_argument('--pool-size', type=int,
+                        default=DEFAULT_POOL_SIZE,
+                        help='HTTP connections kept open to each API \
+                              endpoint; match the number of workers')
+    parser.add_argument('--retries', type=int,
+                        default=DEFAULT_RETRIES,
+                        help='Retries with backoff on 429 and 5xx responses')
+    parser.add_argument('--no-token-cache', dest='token_cache',
+                        action='store_false',
+                        help='Do not reuse the token from the previous run \
+                              (cached in ' + TOKEN_CACHE_DIR + ')')
+    parser.add_argument('-m', '--membership-index',
+                        default=None,
+                        help='Look up project members in this index file \
+                              instead of Keystone; built if missing')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='Refresh the members of all affected projects \
+                              in the membership index')
+    parser.add_argument('--index-max-age', type=float,
+                        default=DEFAULT_INDEX_MAX_AGE,
+                        help='Refresh the members of affected projects \
+                              last refreshed more than this many days ago')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='Rebuild the membership index from scratch')
+    parser.add_argument('-i', '--inventory',
+                        default=None,
+                        help='Read instances, projects and users from this \
+                              JSON file instead of OpenStack')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print one sample notification instead of \
+                              creating an outbox')
+    parser.add_argument('--digest', action='store_true',
+                        help='One email per user covering all their \
+                              projects, with each project instance table \
+                              rendered once (see digest-notification.tmpl)')
 
     return parser
 
@@ -135,7 +268,8 @@ def get_datetime(dt_string):
 
 
 def create_notification(user, start_ts, end_ts, tz, zone, nodes,
-                        test_recipient, work_dir, template, custom_subject):
+                        test_recipient, work_dir, template, custom_subject,
+                        project_tables=None):
     instances = user['instances']
     email = user['email']
     name = user['name']
@@ -143,10 +277,7 @@ def create_notification(user, start_ts, end_ts, tz, zone, nodes,
     subject = 'NeCTAR Research Cloud outage'
     if custom_subject:
         subject = custom_subject
-    affected_instances = 0
-    for project, servers in instances.iteritems():
-        for server in servers:
-            affected_instances += 1
+    affected_instances = sum(len(servers) for servers in instances.values())
 
     affected = bool(affected_instances)
     if affected and not custom_subject:
@@ -166,25 +297,50 @@ def create_notification(user, start_ts, end_ts, tz, zone, nodes,
           (name, email, affected_instances)
 
     if affected_instances > 0:
+        if project_tables is not None:
+            # Only the tables of this user's own projects.
+            project_tables = [project_tables[project_id]
+                              for project_id in user['projects']]
         render_templates(subject, instances, start_ts, end_ts, tz,
                          zone, affected, nodes, work_dir + '/' + email,
-                         template)
+                         template, project_tables)
         return True
 
     return False
 
 
+def get_template_env():
+    global _template_env
+    if _template_env is None:
+        from jinja2 import Environment, FileSystemLoader
+        _template_env = Environment(loader=FileSystemLoader('templates'))
+    return _template_env
+
+
+def render_project_tables(tenant_list, template=DIGEST_PROJECT_TEMPLATE):
+    # Rendered once per project; every member's email reuses the result.
+    # Keyed by id, as project names are only unique within a domain.
+    text = get_template_env().get_template(template)
+    tables = {}
+    for t in tenant_list:
+        if t.instances:
+            tables[t.id] = text.render({'project': t.name,
+                                        'servers': t.instances})
+    return tables
+
+
 def render_templates(subject, instances, start_ts, end_ts, tz, zone,
-                     affected, nodes, filename, template):
+                     affected, nodes, filename, template,
+                     project_tables=None):
 
     duration = end_ts - start_ts if start_ts and end_ts else None
     days = duration.days if duration else None
     hours = duration.seconds//3600 if duration else None
 
-    env = Environment(loader=FileSystemLoader('templates'))
-    text = env.get_template(template)
+    text = get_template_env().get_template(template)
     text = text.render(
                     {'instances': instances,
+                     'project_tables': project_tables,
                      'zone': zone,
                      'start_ts': start_ts,
                      'end_ts': end_ts,
@@ -276,6 +432,46 @@ def get_instances_from_file(client, filename):
             yield client.servers.get(server_id.strip('\n'))
 
 
+def get_instances_from_inventory(servers, zone=None, inst_status=None,
+                                 nodes=None, filename=None):
+    # Same selection as get_instances()/get_instances_from_file(), applied
+    # to the servers of an inventory file.
+    server_ids = None
+    if filename:
+        with open(filename, 'r') as fh:
+            server_ids = set(line.strip('\n') for line in fh)
+    hosts = set(parse_nodes(nodes)) if nodes else None
+    for server in servers:
+        if server_ids is not None:
+            if server.id in server_ids:
+                yield server
+            continue
+        if inst_status is not None and server.status != inst_status:
+            continue
+        if hosts is not None:
+            if getattr(server, 'OS-EXT-SRV-ATTR:host') not in hosts:
+                continue
+        elif zone:
+            instance_az = server._info.get('OS-EXT-AZ:availability_zone') or ''
+            if not instance_az.lower() == zone.lower():
+                continue
+        yield server
+
+
+def load_inventory(filename):
+    """Load servers and project membership recorded in a JSON file.
+
+    The file holds a membership index (see membership.py) plus an
+    'instances' list of server attributes as returned by Nova.
+    """
+    with open(filename) as fh:
+        data = json.load(fh)
+    index = membership.MembershipIndex(data['projects'], data['users'],
+                                       data.get('updated'))
+    servers = [server_obj(info) for info in data['instances']]
+    return servers, index
+
+
 def populate_tenant(keystone, tenant, tenant_data):
     users = get_users(keystone, tenant)
     name = tenant.name
@@ -302,9 +498,8 @@ def generate_log(user_data, tenant_data):
         display_break(' ')
 
         for t_u in t.users:
-            for id, user in  user_data.iteritems():
-                if t_u.id == id:
-                    display_column(str(user['email'])[:40])
+            if t_u.id in user_data:
+                display_column(str(user_data[t_u.id]['email'])[:40])
 
 
 def populate_tenant_users(tenant, data, target_zone, user_data):
@@ -354,7 +549,7 @@ def populate_tenant_users(tenant, data, target_zone, user_data):
 def populate_user(user, user_data):
     if user.id not in user_data:
         user_data[user.id] = {'instances': {},
-                              'email': user._info.get('email', None),
+                              'email': getattr(user, 'email', None),
                               'enabled': user.enabled,
                               'name': user.name}
     return user_data[user.id]
@@ -369,15 +564,16 @@ class tenant_obj():
         self.floating_ips = []
 
 
-def main():
+class server_obj():
+    def __init__(self, info):
+        self._info = info
+        for key, value in info.iteritems():
+            setattr(self, key, value)
 
-    args = collect_args().parse_args()
 
-    sess = get_session(url=None, username=None, password=None,
-                       tenant=None, version=3)
+def main():
 
-    kc = keystone_client.Client(3, session=sess)
-    nc = nova_client.Client(2, session=sess)
+    args = collect_args().parse_args()
 
     zone = args.target_zone
     inst_status = args.status
@@ -407,50 +603,113 @@ def main():
         print "Template could not be found."
         sys.exit(1)
 
-    # Create Outbox Directory and Work Directory
-    work_dir = './outbox/' + datetime.datetime.now().strftime("%y-%m-%d_" +
-                                                              "%H:%M:%S")
-    print "Creating Outbox: " + work_dir
-    os.makedirs(work_dir)
-
     global log_file
-    log_file = open(work_dir + '/' + "notify.log", "w")
-    log_file.write(datetime.datetime.now().strftime("%y-%m-%d_%H:%M:%S"))
+    if args.dry_run:
+        # Nothing is kept: the sample is rendered into a temporary
+        # directory (created just before rendering), printed and removed.
+        work_dir = None
+        log_file = open(os.devnull, "w")
+    else:
+        # Create Outbox Directory and Work Directory
+        work_dir = './outbox/' + datetime.datetime.now().strftime(
+            "%y-%m-%d_" + "%H:%M:%S")
+        print "Creating Outbox: " + work_dir
+        os.makedirs(work_dir)
+
+        log_file = open(work_dir + '/' + "notify.log", "w")
+        log_file.write(datetime.datetime.now().strftime("%y-%m-%d_%H:%M:%S"))
 
     print "Collecting instances"
 
+    sess = None
+    kc = None
+    index = None
+
     # List instances affected by outage
-    affected_instances = list(get_instances_from_file(nc, server_ids_file)
-                              if server_ids_file
-                              else get_instances(nc, zone, inst_status, nodes))
+    if args.inventory:
+        servers, index = load_inventory(args.inventory)
+        affected_instances = list(get_instances_from_inventory(
+            servers, zone, inst_status, nodes, server_ids_file))
+    else:
+        sess = get_session(url=None, username=None, password=None,
+                           tenant=None, version=3, pool_size=args.pool_size,
+                           retries=args.retries,
+                           token_cache=args.token_cache)
+
+        kc = get_keystone_client(sess)
+        nc = get_nova_client(sess)
+
+        affected_instances = list(
+            get_instances_from_file(nc, server_ids_file)
+            if server_ids_file
+            else get_instances(nc, zone, inst_status, nodes))
+
+    if args.digest:
+        # The same server can be listed more than once, e.g. in --file.
+        affected_instances = OrderedDict(
+            (instance.id, instance)
+            for instance in affected_instances).values()
 
     # List tenants associated with affected instances
     affected_tenants = set([instance.tenant_id for instance in affected_instances])
 
-    print "Collecting projects"
-    # Tenant data
-    tenants = kc.projects.list()
-
     # For each affected tenant get the users in the tenant
     tenant_list = []
-    print "Get users per project"
 
-    for t in affected_tenants:
+    if index is None and args.membership_index:
+        print "Loading membership index"
+        index = membership.load_index(args.membership_index, kc,
+                                      rebuild=args.rebuild_index,
+                                      save=not args.dry_run)
+        if args.refresh_index:
+            stale = list(affected_tenants)
+        else:
+            stale = index.stale_projects(
+                affected_tenants,
+                datetime.timedelta(days=args.index_max_age))
+        if stale:
+            print "Refreshing members of %s projects (index updated %s)" % \
+                  (len(stale), index.updated)
+        # Email addresses and enabled flags change more often than
+        # membership; this is the one users.list() call every run made
+        # before the index existed. Done first so that update_projects()
+        # only has to fetch members the list did not return.
+        index.update_users(kc)
+        if stale:
+            index.update_projects(kc, stale)
+        if not args.dry_run:
+            index.save(args.membership_index)
+
+    if index is not None:
+        for t in affected_tenants:
+            new_tenant = tenant_obj()
+            if t in index.projects:
+                new_tenant.id = t
+                new_tenant.name = index.get_project_name(t)
+                new_tenant.users = get_users(kc, t, index)
+            tenant_list.append(new_tenant)
+    else:
+        print "Collecting projects"
+        # Tenant data
+        tenants = kc.projects.list()
+
+        print "Get users per project"
+        for t in affected_tenants:
 
-        new_tenant = tenant_obj()
-        for p in tenants:
-            if t == p.id:
-                new_tenant.id = p.id
-                new_tenant.name = p.name
-                new_tenant.users = get_users(kc, t)
-        tenant_list.append(new_tenant)
+            new_tenant = tenant_obj()
+            for p in tenants:
+                if t == p.id:
+                    new_tenant.id = p.id
+                    new_tenant.name = p.name
+                    new_tenant.users = get_users(kc, t)
+            tenant_list.append(new_tenant)
 
     # Add affected instance objects to tenants.
 
+    tenants_by_id = dict((t.id, t) for t in tenant_list if t.id)
     for instance in affected_instances:
-        for t in tenant_list:
-            if t.id == instance.tenant_id:
-                t.instances.append(instance)
+        if instance.tenant_id in tenants_by_id:
+            tenants_by_id[instance.tenant_id].instances.append(instance)
 
     print "Gathering tenant information."
     proceed = False
@@ -458,39 +717,82 @@ def main():
     # Create a list of affected users and associated instances
 
     user_data = {}
+    project_tables = None
 
-    for t in tenant_list:
-        for user in t.users:
-            populate_user(user, user_data)
-            for instance in t.instances:
-                cur_user = user_data[user.id]
-                if t.name not in cur_user['instances']:
-                    cur_user['instances'][t.name] = []
-                cur_user['instances'][t.name].append(instance)
-
-    for user in kc.users.list():
+    if args.digest:
+        # Members share their project's instance list instead of each
+        # getting a copy, and its table is rendered once.
+        project_tables = render_project_tables(tenant_list)
+
+        for t in tenant_list:
+            for user in t.users:
+                cur_user = populate_user(user, user_data)
+                if t.id not in project_tables:
+                    continue
+                cur_user.setdefault('projects', []).append(t.id)
+                if t.name in cur_user['instances']:
+                    # Another of this user's projects has the same name.
+                    cur_user['instances'][t.name] = \
+                        cur_user['instances'][t.name] + t.instances
+                else:
+                    cur_user['instances'][t.name] = t.instances
+    else:
+        for t in tenant_list:
+            for user in t.users:
+                populate_user(user, user_data)
+                for instance in t.instances:
+                    cur_user = user_data[user.id]
+                    if t.name not in cur_user['instances']:
+                        cur_user['instances'][t.name] = []
+                    cur_user['instances'][t.name].append(instance)
+
+    for user in (index.members() if index else kc.users.list()):
         populate_user(user, user_data)
 
+    if sess is not None and args.token_cache and not args.dry_run:
+        save_auth_state(sess)
+
     generate_log(user_data, tenant_list)
 
     print "Generating notification emails."
     count = 0
     proceed = False
 
-    for uid, user in user_data.iteritems():
-        if test_recipient:
-            # Generate emails for only one email address
-            if user['email'] == test_recipient:
+    if args.dry_run:
+        work_dir = tempfile.mkdtemp(prefix='notify-')
+
+    try:
+        for uid, user in user_data.iteritems():
+            if test_recipient:
+                # Generate emails for only one email address
+                if user['email'] == test_recipient:
+                    if create_notification(user, start_ts, end_ts,
+                                           args.timezone, zone, args.nodes,
+                                           test_recipient, work_dir,
+                                           template, subject,
+                                           project_tables):
+                        count += 1
+            else:
                 if create_notification(user, start_ts, end_ts,
                                        args.timezone, zone, args.nodes,
                                        test_recipient, work_dir,
-                                       template, subject):
-                    count += 1
-        else:
-            if create_notification(user, start_ts, end_ts, args.timezone,
-                                   zone, args.nodes, test_recipient, work_dir,
-                                   template, subject):
-                    count += 1
+                                       template, subject, project_tables):
+                        count += 1
+            if args.dry_run and count:
+                break
+
+        if args.dry_run:
+            log_file.close()
+            for email in os.listdir(work_dir):
+                print "\nSample notification for: " + email + "\n"
+                with open(work_dir + '/' + email) as fh:
+                    print fh.read()
+            if not count:
+                print "\nNo notification would be generated."
+            return
+    finally:
+        if args.dry_run:
+            shutil.rmtree(work_dir)
 
     print '\nTotal instances affected in %s zone: %s' % (zone, len(affected_instances))
     print '\nGenerated %s email notifications.' % count
@@ -0,0 +1,243 @@
+# Description: Persistent project <-> user membership index, so repeated
+#              notifications can look up project members and their email
+#              addresses without asking Keystone every run.
+
+import os
+import json
+import datetime
+import tempfile
+
+INDEX_VERSION = 1
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def now():
+    return datetime.datetime.utcnow().strftime(TIME_FORMAT)
+
+
+class Member(object):
+    """Stand-in for a Keystone user, built from the index."""
+
+    def __init__(self, id, name=None, email=None, enabled=True):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.enabled = enabled
+
+    def __repr__(self):
+        return '<Member %s>' % self.id
+
+
+class MembershipIndex(object):
+    """Bidirectional project <-> user index.
+
+    projects: {project_id: {'name': ..., 'users': [user_id, ...],
+                            'updated': ...}}
+    users:    {user_id: {'name': ..., 'email': ..., 'enabled': ...,
+                         'projects': [project_id, ...]}}
+    """
+
+    def __init__(self, projects=None, users=None, updated=None):
+        self.projects = projects or {}
+        self.users = users or {}
+        self.updated = updated
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fh:
+            data = json.load(fh)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError('%s: unsupported index version %s' %
+                             (filename, data.get('version')))
+        return cls(data['projects'], data['users'], data['updated'])
+
+    def save(self, filename):
+        data = {'version': INDEX_VERSION,
+                'updated': self.updated,
+                'projects': self.projects,
+                'users': self.users}
+        # Write to a temporary file first so an interrupted run never
+        # leaves a truncated index behind.
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def build(cls, keystone):
+        """Build the whole index from three Keystone list calls.
+
+        Members that users.list() does not return are fetched individually.
+        """
+        index = cls()
+        updated = now()
+        for project in keystone.projects.list():
+            index.projects[project.id] = {'name': project.name, 'users': [],
+                                          'updated': updated}
+        listed = set()
+        for user in keystone.users.list():
+            index.add_user(user)
+            listed.add(user.id)
+        for assignment in keystone.role_assignments.list():
+            if not hasattr(assignment, 'user'):
+                continue
+            project = assignment.scope.get('project')
+            if project and project['id'] in index.projects:
+                index.add_member(project['id'], assignment.user['id'])
+        for user_id in [u for u in index.users if u not in listed]:
+            index.fetch_user(keystone, user_id)
+        index.touch()
+        return index
+
+    def touch(self):
+        self.updated = now()
+
+    def stale_projects(self, project_ids, max_age):
+        """Return the project ids missing from the index or whose
+        membership was last refreshed more than max_age (a timedelta) ago.
+        """
+        oldest = (datetime.datetime.utcnow() - max_age).strftime(TIME_FORMAT)
+        stale = []
+        for project_id in project_ids:
+            project = self.projects.get(project_id)
+            # The timestamps sort chronologically as strings.
+            if project is None or project.get('updated', '') < oldest:
+                stale.append(project_id)
+        return stale
+
+    def add_user(self, user):
+        record = self.users.setdefault(user.id, {'projects': []})
+        record['name'] = user.name
+        record['email'] = user._info.get('email', None)
+        record['enabled'] = user.enabled
+
+    def add_member(self, project_id, user_id):
+        users = self.projects[project_id]['users']
+        if user_id not in users:
+            users.append(user_id)
+        record = self.users.setdefault(user_id, {'name': None,
+                                                 'email': None,
+                                                 'enabled': True,
+                                                 'projects': []})
+        if project_id not in record['projects']:
+            record['projects'].append(project_id)
+
+    def remove_user(self, user_id):
+        record = self.users.pop(user_id, None)
+        if record is None:
+            return
+        for project_id in record['projects']:
+            project = self.projects.get(project_id)
+            if project and user_id in project['users']:
+                project['users'].remove(user_id)
+
+    def fetch_user(self, keystone, user_id):
+        """Fetch one user with users.get(), forgetting them if deleted."""
+        from keystoneclient.exceptions import NotFound
+
+        try:
+            self.add_user(keystone.users.get(user_id))
+        except NotFound:
+            self.remove_user(user_id)
+            return False
+        return True
+
+    def remove_project(self, project_id):
+        project = self.projects.pop(project_id, None)
+        if project is None:
+            return
+        for user_id in project['users']:
+            record = self.users.get(user_id)
+            if record and project_id in record['projects']:
+                record['projects'].remove(project_id)
+
+    def update_projects(self, keystone, project_ids):
+        """Refresh the membership of the given projects only.
+
+        Members not in the index yet, or recorded without an email address,
+        are fetched individually, so call update_users() first to have most
+        of them listed in one call. Projects that no longer exist are
+        dropped from the index.
+        """
+        from keystoneclient.exceptions import NotFound
+
+        fetched = set()
+        deleted = set()
+        for project_id in project_ids:
+            self.remove_project(project_id)
+            try:
+                project = keystone.projects.get(project_id)
+            except NotFound:
+                continue
+            self.projects[project.id] = {'name': project.name, 'users': [],
+                                         'updated': now()}
+            for assignment in keystone.role_assignments.list(
+                    project=project_id):
+                if not hasattr(assignment, 'user'):
+                    continue
+                user_id = assignment.user['id']
+                if user_id in deleted:
+                    continue
+                record = self.users.get(user_id)
+                self.add_member(project_id, user_id)
+                if user_id not in fetched and \
+                        (record is None or record['email'] is None):
+                    fetched.add(user_id)
+                    if not self.fetch_user(keystone, user_id):
+                        deleted.add(user_id)
+        self.touch()
+
+    def update_users(self, keystone):
+        """Refresh the email address and enabled flag of every user.
+
+        Users missing from users.list() are fetched individually if they
+        are a project member, and dropped from the index if Keystone no
+        longer knows them.
+        """
+        listed = set()
+        for user in keystone.users.list():
+            self.add_user(user)
+            listed.add(user.id)
+        for user_id in [u for u in self.users if u not in listed]:
+            if self.users[user_id]['projects']:
+                self.fetch_user(keystone, user_id)
+            else:
+                self.remove_user(user_id)
+        self.touch()
+
+    def get_member(self, user_id):
+        record = self.users[user_id]
+        return Member(user_id, record['name'], record['email'],
+                      record['enabled'])
+
+    def get_users(self, project_id):
+        project = self.projects.get(project_id)
+        if project is None:
+            return []
+        return [self.get_member(user_id) for user_id in project['users']]
+
+    def get_projects(self, user_id):
+        record = self.users.get(user_id)
+        return list(record['projects']) if record else []
+
+    def get_project_name(self, project_id):
+        project = self.projects.get(project_id)
+        return project['name'] if project else ''
+
+    def members(self):
+        for user_id in self.users:
+            yield self.get_member(user_id)
+
+
+def load_index(filename, keystone, rebuild=False, save=True):
+    """Load the index from filename, building it from Keystone if needed.
+
+    A newly built index is written to filename unless save is False.
+    """
+    if not rebuild and os.path.exists(filename):
+        return MembershipIndex.load(filename)
+    index = MembershipIndex.build(keystone)
+    if save:
+        index.save(filename)
+    return index